@@ -1,36 +1,164 @@
-import requests
+import aiohttp
+import asyncio
 import sys
+import gzip
 import json
+import orjson
+import ijson
 import time
+from datetime import datetime, timezone
 import os
+from itertools import chain, islice
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop is not available on Windows; fall back to the stdlib event loop
+    uvloop = None
 
-def get_time_buckets(server_url, key, face_id, size="MONTH", verbose=False):
+
+# Bucket assets cached between scheduled runs:
+# (face_id, time_bucket, size) -> (fetched_at, count, etag, last_modified, asset_ids)
+# An entry is only reused while the bucket's count from the time bucket index is unchanged,
+# so late uploads and newly recognized faces in past months are picked up on the next run.
+BUCKET_CACHE = {}
+# Buckets in the current month still receive new assets, so they are refetched often
+CURRENT_BUCKET_TTL = 600
+# Older buckets rarely change; the TTL bounds edits that leave the count unchanged
+HISTORICAL_BUCKET_TTL = 24 * 3600
+# Entries with an ETag/Last-Modified outlive their TTL for revalidation, but only up to this many TTLs
+REVALIDATE_TTL_MULTIPLIER = 7
+
+
+# Parsed config file, reloaded only when its modification time changes
+CONFIG_CACHE = {"mtime": None, "data": None}
+
+
+class ImmichApiError(Exception):
+    pass
+
+
+class TransientApiError(ImmichApiError):
+    # Raised for 5xx and 429 responses, which are worth retrying
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def raise_for_status(status, headers, message):
+    if status >= 500 or status == 429:
+        retry_after = headers.get("Retry-After", "")
+        raise TransientApiError(message, int(retry_after) if retry_after.isdigit() else None)
+    raise ImmichApiError(message)
+
+
+MAX_RETRY_WAIT = 30
+
+
+def wait_for_retry(retry_state):
+    # Honour the server's Retry-After when rate limited, otherwise back off exponentially
+    retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+    if retry_after is not None:
+        return min(retry_after, MAX_RETRY_WAIT)
+    return wait_exponential(multiplier=1, max=MAX_RETRY_WAIT)(retry_state)
+
+
+api_retry = retry(
+    wait=wait_for_retry,
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(
+        (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, TransientApiError)
+    ),
+    reraise=True,
+)
+
+
+def bucket_ttl(time_bucket):
+    # Time buckets are ISO dates, so comparing the "YYYY-MM" prefix is enough
+    current_month = datetime.now(timezone.utc).strftime("%Y-%m")
+    if time_bucket and time_bucket[:7] < current_month:
+        return HISTORICAL_BUCKET_TTL
+    return CURRENT_BUCKET_TTL
+
+
+def cleanup_bucket_cache():
+    # Expired entries with a validator are kept a while longer so they can be revalidated with a
+    # conditional GET; anything not refreshed within that window (e.g. a removed face) is dropped
+    now = time.monotonic()
+    expired = [
+        cache_key
+        for cache_key, (fetched_at, _, etag, last_modified, _) in BUCKET_CACHE.items()
+        if now - fetched_at
+        > bucket_ttl(cache_key[1]) * (REVALIDATE_TTL_MULTIPLIER if etag or last_modified else 1)
+    ]
+    for cache_key in expired:
+        del BUCKET_CACHE[cache_key]
+
+
+def load_config(config_path):
+    mtime = os.stat(config_path).st_mtime
+    if mtime != CONFIG_CACHE["mtime"]:
+        with open(config_path, "r") as f:
+            CONFIG_CACHE["data"] = json.load(f)
+        CONFIG_CACHE["mtime"] = mtime
+        print(f"Loaded config: {CONFIG_CACHE['data']}")
+    return CONFIG_CACHE["data"]
+
+
+def create_session(key):
+    # Reuse keep-alive connections across every API call instead of opening a new one per request
+    connector = aiohttp.TCPConnector(limit_per_host=64)
+    headers = {"x-api-key": key, "Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+
+@api_retry
+async def get_time_buckets(session, server_url, face_id, size="MONTH", verbose=0):
     url = f"{server_url}/api/timeline/buckets"
-    headers = {"x-api-key": key, "Accept": "application/json"}
     params = {"personId": face_id, "size": size}
 
     if verbose:
         print(f"Fetching time buckets from {url} with params: {params}")
 
-    response = requests.get(url, headers=headers, params=params)
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            time_buckets = orjson.loads(await response.read())
+            if verbose >= 2:
+                print(f"Time buckets fetched: {time_buckets}")
+            elif verbose:
+                print(f"Time buckets fetched: {len(time_buckets)} bucket(s)")
+            return time_buckets
+        else:
+            raise_for_status(
+                response.status,
+                response.headers,
+                f"Failed to fetch time buckets. Status code: {response.status}, Response text: {await response.text()}",
+            )
+
 
-    if response.status_code == 200:
+@api_retry
+async def get_assets_for_time_bucket(
+    session, server_url, face_id, time_bucket, size="MONTH", verbose=0, count=None
+):
+    cache_key = (face_id, time_bucket, size)
+    cached = BUCKET_CACHE.get(cache_key)
+    if cached and cached[1] == count and time.monotonic() - cached[0] <= bucket_ttl(time_bucket):
         if verbose:
-            print(f"Time buckets fetched: {response.json()}")
-        return response.json()
-    else:
-        print(f"Failed to fetch time buckets. Status code: {response.status_code}, Response text: {response.text}")
-        exit(1)
+            print(f"Using cached assets for time bucket {time_bucket} of face {face_id}")
+        return cached[4]
 
+    headers = {}
+    if cached:
+        _, _, etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
 
-def get_assets_for_time_bucket(
-    server_url, key, face_id, time_bucket, size="MONTH", verbose=False
-):
     url = f"{server_url}/api/timeline/bucket"
-    headers = {"x-api-key": key, "Accept": "application/json"}
     params = {
         "isArchived": "false",
         "personId": face_id,
@@ -41,54 +169,130 @@ def get_assets_for_time_bucket(
     if verbose:
         print(f"Fetching assets for time bucket {time_bucket} from {url} with params: {params}")
 
-    response = requests.get(url, headers=headers, params=params)
+    async with session.get(url, params=params, headers=headers) as response:
+        if response.status == 304 and cached:
+            if verbose:
+                print(f"Assets not modified for time bucket {time_bucket} of face {face_id}")
+            BUCKET_CACHE[cache_key] = (time.monotonic(), count, *cached[2:])
+            return cached[4]
+        if response.status == 200:
+            # Stream only the "id" column out of the body instead of materializing every asset field.
+            # "id.item" matches elements of the id array, so a malformed bare string yields nothing.
+            # Interning lets the same ID seen by several faces, buckets and the cache share one object.
+            asset_ids = [sys.intern(asset_id) async for asset_id in ijson.items(response.content, "id.item")]
+            if verbose >= 2:
+                print(f"Assets fetched: {asset_ids}")
+            elif verbose:
+                print(f"Assets fetched: {len(asset_ids)} id(s)")
+            BUCKET_CACHE[cache_key] = (
+                time.monotonic(),
+                count,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                asset_ids,
+            )
+            return asset_ids
+        else:
+            raise_for_status(
+                response.status,
+                response.headers,
+                f"Failed to fetch assets for time bucket {time_bucket}. Status code: {response.status}, Response text: {await response.text()}",
+            )
 
-    if response.status_code == 200:
-        if verbose:
-            print(f"Assets fetched: {response.json()}")
-        return response.json()
-    else:
-        print(f"Failed to fetch assets for time bucket {time_bucket}. Status code: {response.status_code}, Response text: {response.text}")
-        exit(1)
 
+async def gather_all(*aws):
+    # Like asyncio.gather, but lets every sibling finish before raising the first error,
+    # so nothing is left running against a session that is about to close
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
 
-def add_assets_to_album(server_url, key, album_id, asset_ids, verbose=False):
-    url = f"{server_url}/api/albums/{album_id}/assets"
-    headers = {
-        "x-api-key": key,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-    payload = json.dumps({"ids": asset_ids})
 
-    if verbose:
-        print(f"Adding assets to album {album_id} with payload: {payload}")
+def fetch_time_bucket_once(
+    pending, session, server_url, face_id, time_bucket, size="MONTH", verbose=0, count=None
+):
+    # Share one request between every caller asking for the same bucket during a run
+    pending_key = (face_id, time_bucket, size)
+    if pending_key not in pending:
+        pending[pending_key] = asyncio.ensure_future(
+            get_assets_for_time_bucket(session, server_url, face_id, time_bucket, size, verbose, count)
+        )
+    return pending[pending_key]
 
-    response = requests.put(url, headers=headers, data=payload)
 
-    if response.status_code == 200:
-        if verbose:
-            print(f"Assets added to album: {asset_ids}")
-        return True
-    else:
+async def get_asset_ids_for_face(
+    session, semaphore, pending, server_url, face_id, size="MONTH", verbose=0, only_time_buckets=None
+):
+    # Returns the face's asset IDs and the time buckets they were fetched from.
+    # only_time_buckets restricts fetching to those buckets, skipping ones that cannot matter.
+    async with semaphore:
+        time_buckets = await get_time_buckets(session, server_url, face_id, size, verbose)
+        bucket_counts = {bucket.get("timeBucket"): bucket.get("count") for bucket in time_buckets}
+        bucket_times = set(bucket_counts)
+        if only_time_buckets is not None:
+            bucket_times &= only_time_buckets
         if verbose:
-            print(f"Error response: Status code: {response.status_code}, Response text: {response.text}")
-            try:
-                error_response = response.json()
-                print(f"Full error JSON: {json.dumps(error_response, indent=2)}")
-            except json.JSONDecodeError:
-                print(f"Failed to decode JSON response. Response text: {response.text}")
+            estimated = sum(bucket_counts[bucket_time] or 0 for bucket_time in bucket_times)
+            print(f"Expecting about {estimated} asset(s) across {len(bucket_times)} bucket(s) for face {face_id}")
+        tasks = [
+            fetch_time_bucket_once(
+                pending, session, server_url, face_id, bucket_time, size, verbose, bucket_counts[bucket_time]
+            )
+            for bucket_time in bucket_times
+        ]
+        bucket_results = await gather_all(*tasks)
+        return frozenset(chain.from_iterable(bucket_results)), bucket_times
+
+
+@api_retry
+async def add_assets_to_album(session, server_url, album_id, asset_ids, verbose=0):
+    url = f"{server_url}/api/albums/{album_id}/assets"
+    # Lists of UUIDs compress very well; Immich's JSON body parser inflates gzip request bodies
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    payload = orjson.dumps({"ids": asset_ids})
+
+    if verbose >= 2:
+        print(f"Adding assets to album {album_id} with payload: {payload.decode()}")
+
+    async with session.put(url, headers=headers, data=gzip.compress(payload)) as response:
+        if response.status == 200:
+            if verbose >= 2:
+                print(f"Assets added to album: {asset_ids}")
+            return True
         else:
-            try:
-                error_response = response.json()
-                print(f"Error adding assets to album: {error_response.get('error', 'Unknown error')}")
-            except json.JSONDecodeError:
-                print(f"Failed to decode JSON response. Status code: {response.status_code}, Response text: {response.text}")
-        return False
+            response_text = await response.text()
+            if response.status >= 500 or response.status == 429:
+                raise_for_status(
+                    response.status,
+                    response.headers,
+                    f"Failed to add assets to album {album_id}. Status code: {response.status}, Response text: {response_text}",
+                )
+            if verbose:
+                print(f"Error response: Status code: {response.status}, Response text: {response_text}")
+                try:
+                    error_response = json.loads(response_text)
+                    print(f"Full error JSON: {json.dumps(error_response, indent=2)}")
+                except json.JSONDecodeError:
+                    print(f"Failed to decode JSON response. Response text: {response_text}")
+            else:
+                try:
+                    error_response = json.loads(response_text)
+                    print(f"Error adding assets to album: {error_response.get('error', 'Unknown error')}")
+                except json.JSONDecodeError:
+                    print(f"Failed to decode JSON response. Status code: {response.status}, Response text: {response_text}")
+            return False
 
 
-def chunker(seq, size):
-    return (seq[pos : pos + size] for pos in range(0, len(seq), size))
+try:
+    from itertools import batched
+except ImportError:
+    # itertools.batched is only available from Python 3.12
+    def batched(iterable, n):
+        iterator = iter(iterable)
+        while batch := tuple(islice(iterator, n)):
+            yield batch
 
 
 def face_to_album():
@@ -98,7 +302,9 @@ def face_to_album():
     config = os.environ.get("CONFIG_PATH", "/app/config.json")
     album = os.environ.get("IMMICH_ALBUM_ID")
     timebucket = os.environ.get("TIME_BUCKET", "MONTH")
-    verbose = os.environ.get("VERBOSE", "false").lower() == "true"
+    # VERBOSE=true (or 1) logs progress and counts; VERBOSE=2 also dumps full API payloads
+    verbose = os.environ.get("VERBOSE", "false").lower()
+    verbose = 1 if verbose == "true" else int(verbose) if verbose.isdigit() else 0
     run_every_seconds = int(os.environ.get("RUN_EVERY_SECONDS", "0"))
     # Faces and skip faces can be comma-separated lists
     face = os.environ.get("IMMICH_FACE_IDS", "")
@@ -109,82 +315,112 @@ def face_to_album():
     If --config is provided, load mappings from config file and process each mapping.
     Otherwise, fallback to CLI options for backward compatibility.
     """
-    def process_mapping(mapping):
+    async def process_mapping(session, pending, semaphore, album_semaphore, mapping):
         # mapping: {"faceIds": [...], "albumId": ...}
-        unique_asset_ids = set()
         print(f"Processing mapping: {mapping}")
         album_id = mapping["albumId"]
         face_ids = mapping["faceIds"]
         skip_face_ids = mapping.get("skipFaceIds", [])
         print(f"Album ID: {album_id}, Face IDs: {face_ids}, Skip Face IDs: {skip_face_ids}")
-        for face_id in face_ids:
-            if verbose:
-                print(f"Processing face ID: {face_id} for album {album_id}")
-            time_buckets = get_time_buckets(server, key, face_id, timebucket, verbose)
-            for bucket in time_buckets:
-                bucket_time = bucket.get("timeBucket")
-                bucket_assets = get_assets_for_time_bucket(server, key, face_id, bucket_time, timebucket, verbose)
-                unique_asset_ids.update(bucket_assets["id"])
-        # Exclude assets for skip faces
+        if verbose:
+            print(f"Processing face IDs: {face_ids} for album {album_id}")
+        include_results = await gather_all(*(
+            get_asset_ids_for_face(session, semaphore, pending, server, face_id, timebucket, verbose)
+            for face_id in face_ids
+        ))
+        unique_asset_ids = frozenset(chain.from_iterable(asset_ids for asset_ids, _ in include_results))
+        # Exclude assets for skip faces, only looking at time buckets that contributed assets
         if skip_face_ids:
-            skip_asset_ids = set()
-            for s_face in skip_face_ids:
-                if verbose:
-                    print(f"Collecting assets to skip for face ID: {s_face}")
-                time_buckets = get_time_buckets(server, key, s_face, timebucket, verbose)
-                for bucket in time_buckets:
-                    bucket_time = bucket.get("timeBucket")
-                    bucket_assets = get_assets_for_time_bucket(server, key, s_face, bucket_time, timebucket, verbose)
-                    skip_asset_ids.update(bucket_assets["id"])
+            if verbose:
+                print(f"Collecting assets to skip for face IDs: {skip_face_ids}")
+            include_bucket_times = set().union(*(bucket_times for _, bucket_times in include_results))
+            skip_results = await gather_all(*(
+                get_asset_ids_for_face(
+                    session, semaphore, pending, server, s_face, timebucket, verbose, include_bucket_times
+                )
+                for s_face in skip_face_ids
+            ))
+            skip_asset_ids = frozenset(chain.from_iterable(asset_ids for asset_ids, _ in skip_results))
             before = len(unique_asset_ids)
-            unique_asset_ids.difference_update(skip_asset_ids)
+            unique_asset_ids = unique_asset_ids - skip_asset_ids
             removed = before - len(unique_asset_ids)
             print(f"Excluded {removed} asset(s) belonging to skipped face(s)")
         print(f"Total unique assets to add to album {album_id}: {len(unique_asset_ids)}")
-        asset_ids_list = list(unique_asset_ids)
-        for asset_chunk in chunker(asset_ids_list, 500):
-            if verbose:
-                print(f"Adding chunk of {len(asset_chunk)} assets to album {album_id}")
-            success = add_assets_to_album(server, key, album_id, asset_chunk, verbose)
-            if success:
-                print(f"Added {len(asset_chunk)} asset(s) to the album {album_id}")
+        # Chunks are independent, so add them concurrently within the server's capacity
+        async def add_chunk(asset_chunk):
+            async with album_semaphore:
+                if verbose:
+                    print(f"Adding chunk of {len(asset_chunk)} assets to album {album_id}")
+                success = await add_assets_to_album(session, server, album_id, asset_chunk, verbose)
+                if success:
+                    print(f"Added {len(asset_chunk)} asset(s) to the album {album_id}")
 
-    def run_once():
+        await gather_all(*(add_chunk(asset_chunk) for asset_chunk in batched(unique_asset_ids, 500)))
+
+    async def process_mapping_safely(session, pending, semaphore, album_semaphore, mapping):
+        # A failing mapping (a deleted person ID, a typo in the config, a malformed response)
+        # must not stop the others from syncing
+        try:
+            await process_mapping(session, pending, semaphore, album_semaphore, mapping)
+        except Exception as e:
+            album_id = mapping.get("albumId") if isinstance(mapping, dict) else None
+            print(f"Failed to sync album {album_id}: {type(e).__name__}: {e}")
+            return False
+        return True
+
+    async def run_once():
+        cleanup_bucket_cache()
         if config and os.path.exists(config):
-            with open(config, "r") as f:
-                config_data = json.load(f)
-            print(f"Loaded config: {config_data}")
-            mappings = config_data.get("mappings", [])
-            for mapping in mappings:
-                process_mapping(mapping)
+            mappings = load_config(config).get("mappings", [])
         else:
             # fallback to env options
-            mapping = {
+            mappings = [{
                 "faceIds": face,
                 "albumId": album,
                 "skipFaceIds": skip_face
-            }
-            process_mapping(mapping)
+            }]
+        # (face_id, time_bucket, size) -> in-flight or finished bucket fetch, shared across mappings
+        pending = {}
+        # Bounds shared by every mapping in the run so the server is not flooded:
+        # faces fetched concurrently, and album chunks added concurrently
+        semaphore = asyncio.Semaphore(16)
+        album_semaphore = asyncio.Semaphore(8)
+        # One event loop and one connection pool shared by every mapping
+        async with create_session(key) as session:
+            results = await asyncio.gather(*(
+                process_mapping_safely(session, pending, semaphore, album_semaphore, mapping)
+                for mapping in mappings
+            ))
+        return all(results)
+
+    def run_once_sync():
+        try:
+            return (uvloop.run if uvloop else asyncio.run)(run_once())
+        except (ImmichApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Sync failed: {e}")
+            return False
 
     cron_expr = os.environ.get("CRON_EXPRESSION")
     if cron_expr:
         print(f"Scheduling sync with CRON_EXPRESSION: {cron_expr}")
         scheduler = BlockingScheduler()
-        scheduler.add_job(run_once, CronTrigger.from_crontab(cron_expr))
+        scheduler.add_job(run_once_sync, CronTrigger.from_crontab(cron_expr))
         try:
             scheduler.start()
         except (KeyboardInterrupt, SystemExit):
             print("Scheduler stopped.")
     elif run_every_seconds and run_every_seconds > 0:
+        # Fixed cadence: the period does not drift by the duration of each run
+        print(f"Scheduling sync every {run_every_seconds} second(s)")
+        scheduler = BlockingScheduler()
+        scheduler.add_job(run_once_sync, "interval", seconds=run_every_seconds, next_run_time=datetime.now())
         try:
-            while True:
-                run_once()
-                print(f"Waiting {run_every_seconds} second(s) before next execution...")
-                time.sleep(run_every_seconds)
-        except KeyboardInterrupt:
+            scheduler.start()
+        except (KeyboardInterrupt, SystemExit):
             print("Stop requested (Ctrl+C). Ending repeated execution.")
     else:
-        run_once()
+        if not run_once_sync():
+            exit(1)
 
 
 def main(args=None):
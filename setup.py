@@ -50,7 +50,7 @@ For example, to run the command every hour, you can add the following to your cr
     url="https://github.com/romainrbr/immich-face-to-album",
     download_url="https://github.com/romainrbr/immich-face-to-album/archive/v_01.tar.gz",
     keywords=["immich"],
-    install_requires=["click", "requests"],
+    install_requires=["click", "aiohttp", "tenacity", "orjson", "ijson", 'uvloop; sys_platform != "win32"'],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",